@@ -9,24 +9,144 @@ This app demonstrates Google ADK's SequentialAgent pattern:
 
 import gradio as gr
 import asyncio
+import ast
+import csv
+import functools
+import io
+import json
+import logging
 import os
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import re
 import altair as alt
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from google.genai import types
 import tempfile
 import random
+import threading
 from datetime import datetime
 # Import root agent runner
 from bi_agent import root_runner
 from bi_agent.tools import generate_report_pdf
 
-# Global variable to store current dataframe for download
-current_df_storage = None
+# State keys produced by root_agent that the UI needs
+PIPELINE_OUTPUT_KEYS = {
+    'sql_query',
+    'query_results',
+    'chart_spec',
+    'explanation_text',
+    'trend_insights',
+}
+
+# Modules generated chart code may import, and statements allowed at its top level
+CHART_ALLOWED_MODULES = {'altair', 'pandas'}
+CHART_ALLOWED_STATEMENTS = (
+    ast.Import, ast.ImportFrom, ast.Assign, ast.AugAssign, ast.AnnAssign,
+    ast.Expr, ast.If, ast.For, ast.FunctionDef,
+)
+
+# Markdown code fence at either end of an LLM response (```json ... ```)
+_FENCE = re.compile(r'^```[a-z]*\s*|\s*```$', re.IGNORECASE)
+
+
+def _nan_to_null(table: pa.Table) -> pa.Table:
+    """Store NaN in floating columns as Arrow null (the JSON payload encodes SQL NULL as NaN)."""
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type):
+            column = table.column(i)
+            table = table.set_column(
+                i, field, pc.if_else(pc.is_nan(column), pa.scalar(None, field.type), column)
+            )
+    return table
+
+
+class _ChartNamespace(dict):
+    """Globals for chart code; 'data' (df as records) is built on first lookup."""
+
+    def __missing__(self, key):
+        if key == 'data':
+            df = self['df']
+            try:
+                value = _nan_to_null(pa.Table.from_pandas(df, preserve_index=False)).to_pylist()
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                value = df.to_dict(orient='records')
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_chart(chart_code: str):
+    """
+    Validate and compile generated chart code, caching the result per spec.
+
+    The code is rejected if it does not parse, has a top-level statement
+    outside CHART_ALLOWED_STATEMENTS, or imports anything outside
+    CHART_ALLOWED_MODULES.
+
+    Args:
+        chart_code: Cleaned Python source from the visualization agent
+
+    Returns:
+        Tuple of (code object or None, rejection reason or None)
+    """
+    try:
+        tree = ast.parse(chart_code, '<chart_spec>')
+    except SyntaxError as e:
+        return None, f"syntax error: {e}"
+
+    if not all(isinstance(node, CHART_ALLOWED_STATEMENTS) for node in tree.body):
+        return None, "unsupported top-level statement"
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            continue
+        if any(module.split('.')[0] not in CHART_ALLOWED_MODULES for module in modules):
+            return None, f"disallowed import: {', '.join(modules)}"
+
+    return compile(tree, '<chart_spec>', 'exec'), None
+
+
+# Pipeline results for recently asked questions (normalized question -> results)
+_RESULTS_CACHE = TTLCache(maxsize=256, ttl=600)
+
+# Questions whose answer depends on when they are asked are never cached
+_TIME_SENSITIVE = re.compile(r'\b(now|today|yesterday|current(ly)?|latest|recent(ly)?)\b', re.IGNORECASE)
 
 # Load environment variables from bi_agent/.env
 load_dotenv(dotenv_path='bi_agent/.env')
 
+# Verbose per-request logging, enabled with BI_DEBUG=1
+DEBUG = os.environ.get('BI_DEBUG') == '1'
+logger = logging.getLogger(__name__)
+if DEBUG:
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+
+# Global variable to store current dataframe for download
+current_df_storage = None
+
+# Last exported files, reused while current_df_storage is unchanged
+_export_cache = {'df_id': None, 'csv': None, 'parquet': None}
+
+# Persistent event loop for the ADK pipeline (uvloop where available)
+try:
+    import uvloop
+    _LOOP = uvloop.new_event_loop()
+except ImportError:
+    _LOOP = asyncio.new_event_loop()
+threading.Thread(target=_LOOP.run_forever, daemon=True).start()
+
 js_code = """
 function createGradioAnimation() {
     // Add font from Google Fonts
@@ -104,7 +224,8 @@ async def run_bi_pipeline_async(user_question: str):
         user_question: Natural language question from the user
 
     Returns:
-        Dictionary with keys: sql_query, query_results, chart_spec, explanation_text
+        Dictionary with keys: sql_query, query_results, chart_spec,
+        explanation_text, trend_insights
     """
     # Create session
     session = await root_runner.session_service.create_session(
@@ -125,12 +246,18 @@ async def run_bi_pipeline_async(user_question: str):
         new_message=content
     )
 
-    # Extract results from state
+    # Extract results from state (only the keys the UI consumes)
     results = {}
     async for event in events_async:
         if event.actions and event.actions.state_delta:
             for key, value in event.actions.state_delta.items():
-                results[key] = value
+                if key in PIPELINE_OUTPUT_KEYS:
+                    results[key] = value
+            if PIPELINE_OUTPUT_KEYS.issubset(results):
+                break
+
+    # Release the runner's generator if we stopped early
+    await events_async.aclose()
 
     return results
 
@@ -145,6 +272,10 @@ async def process_request_async(message: str):
     3. Data Formatter Agent → Formats results
     4. Insight Pipeline → Visualization + Explanation
 
+    Pipeline results are cached for 10 minutes per question once the query
+    has executed successfully, except for time-sensitive questions (e.g.
+    containing "today" or "now").
+
     Args:
         message: User's natural language question
 
@@ -157,8 +288,15 @@ async def process_request_async(message: str):
         if not message.strip():
             return "Error: Please enter a question", None, None, "Error: No question provided"
 
+        # Repeated questions skip the LLM + SQL pipeline entirely
+        cache_key = message.strip().lower()
+        cacheable = not _TIME_SENSITIVE.search(cache_key)
+        results = _RESULTS_CACHE.get(cache_key) if cacheable else None
+        from_cache = results is not None
+
         # Run the complete BI pipeline
-        results = await run_bi_pipeline_async(message)
+        if not from_cache:
+            results = await run_bi_pipeline_async(message)
 
         # Extract SQL query
         sql_query = results.get('sql_query', '')
@@ -168,28 +306,27 @@ async def process_request_async(message: str):
             sql_query = sql_query.split('</thinking_process>')[-1].strip()
         # Clean up SQL query (remove markdown if present)
         sql_query = sql_query.strip()
-        if sql_query.startswith("```sql"):
-            sql_query = sql_query.replace("```sql", "").replace("```", "").strip()
-        elif sql_query.startswith("```"):
-            sql_query = sql_query.replace("```", "").strip()
+        if sql_query.startswith('```'):
+            sql_query = _FENCE.sub('', sql_query).strip()
 
         # Extract query results
         query_results_str = results.get('query_results', '{}')
-        print(f"DEBUG: query_results_str = {repr(query_results_str)}")
+        if DEBUG:
+            logger.debug("query_results_str = %r", query_results_str)
 
         query_results = {'success': False, 'data': [], 'error': 'Uninitialized'} 
 
         try:
-            import json
-            import re
-            
             raw_str = str(query_results_str).strip()
             
             # Method 1: Try parsing as JSON
-            clean_json = re.sub(r'^```[a-z]*\s*', '', raw_str, flags=re.IGNORECASE)
-            clean_json = re.sub(r'\s*```$', '', clean_json)
+            clean_json = _FENCE.sub('', raw_str) if raw_str.startswith('```') else raw_str
             
-            parsed_json = json.loads(clean_json)
+            try:
+                parsed_json = orjson.loads(clean_json)
+            except orjson.JSONDecodeError:
+                # execute_sql_and_format emits bare NaN for NULLs, which only stdlib json accepts
+                parsed_json = json.loads(clean_json)
             
             if isinstance(parsed_json, list):
                 query_results = {'success': True, 'data': parsed_json}
@@ -205,31 +342,41 @@ async def process_request_async(message: str):
                 table_lines = [line.strip() for line in lines if '|' in line and line.strip()]
                 
                 if len(table_lines) >= 3:  # Header, separator, at least 1 data row
-                    headers = [h.strip() for h in table_lines[0].strip('|').split('|')]
-                    headers = [h.replace('\\_', '_') for h in headers]  # Remove escaping
-                    data_list = []
-                    
-                    for line in table_lines[2:]:  # Skip separator
+                    # Drop separator rows, rows whose cell count differs from the
+                    # header and repeated headers, then parse in one C pass
+                    header = table_lines[0].strip('|')
+                    header_cells = [h.strip() for h in header.split('|')]
+                    cell_separators = header.count('|')
+                    rows = [header]
+                    for line in table_lines[2:]:
                         if line.startswith(':') or '---' in line:
                             continue
-                        values = [v.strip() for v in line.strip('|').split('|')]
-                        if len(values) == len(headers) and values != headers:
-                            row_dict = {}
-                            for i, header in enumerate(headers):
-                                val = values[i] if i < len(values) else ''
-                                # Try to convert to numeric
-                                try:
-                                    row_dict[header] = float(val)
-                                except (ValueError, TypeError):
-                                    row_dict[header] = val
-                            data_list.append(row_dict)
-                    
-                    if data_list:
+                        line = line.strip('|')
+                        if line.count('|') != cell_separators:
+                            continue
+                        if (line.split('|', 1)[0].strip() == header_cells[0]
+                                and [v.strip() for v in line.split('|')] == header_cells):
+                            continue
+                        rows.append(line)
+                    df_table = pd.read_csv(
+                        io.StringIO('\n'.join(rows)),
+                        sep='|',
+                        engine='c',
+                        skipinitialspace=True,
+                        quoting=csv.QUOTE_NONE,
+                        on_bad_lines='skip'
+                    )
+                    df_table.columns = df_table.columns.str.strip().str.replace('\\_', '_', regex=False)  # Remove escaping
+                    for col in df_table.select_dtypes(include='object').columns:
+                        df_table[col] = df_table[col].str.strip()
+
+                    table_rows = df_table.shape[0]
+                    if table_rows:
                         query_results = {
                             'success': True, 
-                            'data': data_list
+                            'data': df_table
                         }
-                        print(f"✅ Successfully parsed Markdown Table ({len(data_list)} rows)")
+                        print(f"✅ Successfully parsed Markdown Table ({table_rows} rows)")
                     else:
                         raise ValueError("No data rows extracted from table")
                 else:
@@ -251,13 +398,26 @@ async def process_request_async(message: str):
             sql_query = f"-- Error executing query\n{sql_query}\n\n-- Error: {error_msg}"
             return sql_query, None, None, f"Error executing query: {error_msg}"
 
-        # Convert query results to DataFrame
+        # Only cache fresh, complete runs whose query succeeded (re-storing a
+        # cache hit would reset its TTL and keep it alive indefinitely)
+        if cacheable and not from_cache and PIPELINE_OUTPUT_KEYS.issubset(results):
+            _RESULTS_CACHE[cache_key] = results
+
+        # Convert query results to DataFrame (markdown tables arrive already parsed)
         data_list = query_results.get('data', [])
-        if not data_list:
+        if isinstance(data_list, pd.DataFrame):
+            df = data_list
+        elif not data_list:
             df = pd.DataFrame()
             return sql_query, df, None, "The query executed successfully but returned no data."
-
-        df = pd.DataFrame(data_list)
+        else:
+            try:
+                # Bulk Arrow conversion keeps string columns out of Python objects
+                table = _nan_to_null(pa.Table.from_pylist(data_list))
+                df = table.to_pandas(types_mapper=pd.ArrowDtype)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Mixed-type columns: fall back to pandas' own inference
+                df = pd.DataFrame.from_records(data_list)
 
         # --- ส่วนที่แก้ไข: ดึงค่าจาก Trend Analyst และ Explanation Agent ---
         trend_text = results.get('trend_insights', '')
@@ -274,9 +434,8 @@ async def process_request_async(message: str):
         if not final_insights:
             final_insights = "The query executed successfully but no additional insights were generated."
 
-        # Extract chart specification and explanation
+        # Extract chart specification
         chart_spec = results.get('chart_spec', '')
-        explanation_text = results.get('explanation_text', '')
 
         # Execute chart specification
         chart = None
@@ -290,40 +449,45 @@ async def process_request_async(message: str):
                     chart_spec_clean = parts[-1].strip() if len(parts) > 1 else chart_spec_clean
                 
                 # Remove markdown code blocks
-                chart_spec_clean = chart_spec_clean.replace("```python", "").replace("```", "").strip()
+                if '```' in chart_spec_clean:
+                    chart_spec_clean = chart_spec_clean.replace("```python", "").replace("```", "").strip()
                 
                 # Skip if no valid code found
                 if not chart_spec_clean or chart_spec_clean.startswith('<') or 'import' not in chart_spec_clean.lower():
-                    print("No valid chart code found, skipping chart generation")
+                    logger.warning("No valid chart code found, skipping chart generation")
                     chart = None
                 else:
-                    namespace = {
-                        'alt': alt,
-                        'pd': pd,
-                        'df': df,
-                        'data': df.to_dict(orient='records')
-                    }
-                    exec(chart_spec_clean, namespace)
-                    chart = namespace.get('chart')
-                    if chart:
-                        print("Chart generated successfully")
+                    chart_code, reject_reason = _compile_chart(chart_spec_clean)
+                    if chart_code is None:
+                        logger.warning("Chart code rejected (%s), skipping chart generation", reject_reason)
                     else:
-                        print("Chart variable not found in executed code")
+                        namespace = _ChartNamespace(
+                            alt=alt,
+                            pd=pd,
+                            df=df
+                        )
+                        exec(chart_code, namespace)
+                        chart = namespace.get('chart')
+                        if chart:
+                            logger.info("Chart generated successfully")
+                        else:
+                            logger.warning("Chart variable not found in executed code")
                         
-            except SyntaxError as e:
-                print(f"Chart syntax error: {e}")
             except Exception as e:
-                print(f"Chart generation warning: {e}")
+                logger.warning("Chart generation warning: %s", e)
 
         # Return all four outputs
         return sql_query, df, chart, final_insights
 
     except Exception as e:
         error_msg = f"Error: {str(e)}"
-        print(f"Full error: {e}")
-        import traceback
-        traceback.print_exc()
+        if DEBUG:
+            logger.exception("Pipeline error")
+        else:
+            logger.error("Pipeline error: %s", e)
         return error_msg, None, None, error_msg
+
+
 def create_no_data_chart():
     "Create a simulated graph to inform the user that there is no data to display."
     import altair as alt
@@ -349,66 +513,131 @@ def create_no_data_chart():
     )
     return chart
 
-def process_request(message: str):
+async def process_request(message: str):
     """
-    Synchronous wrapper for Gradio.
+    Async Gradio handler.
+
+    The pipeline runs on the persistent _LOOP so its CPU-bound parsing and
+    chart execution never block Gradio's own event loop.
 
     Database credentials are read from environment variables in bi_agent/.env
     """
     global current_df_storage
     try:
-        sql_query, df, chart, explanation = asyncio.run(
-            process_request_async(message)
+        sql_query, df, chart, explanation = await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(process_request_async(message), _LOOP)
         )
         # Managing Empty Data
-        if df is None or df.empty:
+        row_count = df.shape[0] if df is not None else 0
+        if row_count == 0:
             # If no data is available, submit a Placeholder graph instead. (None)
             no_data_chart = create_no_data_chart()
             current_df_storage = None
+            _export_cache['df_id'] = None
             return sql_query, df, no_data_chart, explanation
         # Store dataframe for download
         current_df_storage = df
-        print(f"DEBUG: Stored dataframe with {len(df) if df is not None else 0} rows")
+        _export_cache['df_id'] = None
+        if DEBUG:
+            logger.debug("Stored dataframe with %d rows", row_count)
         return sql_query, df, chart, explanation
     except Exception as e:
         error_msg = f"Error: {str(e)}"
         return error_msg, None, None, error_msg
 
 
-def download_query_results() -> str:
+def _write_csv(df: pd.DataFrame, path: str):
     """
-    Download query results as CSV file.
+    Write df as CSV with Arrow's C writer, falling back to pandas for mixed-type columns.
+
+    Arrow's output differs from df.to_csv: the header and every string cell
+    are quoted, booleans are written as true/false and whole floats drop
+    the trailing '.0' (1.0 -> 1).
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df.to_csv(path, index=False, encoding='utf-8', chunksize=50_000)
+        return
+    pacsv.write_csv(table, path)
+
+
+def _write_parquet(df: pd.DataFrame, path: str):
+    """Write df as a Parquet file."""
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), path)
+
+
+def _export_query_results(file_format: str, writer) -> str:
+    """
+    Export the current query results to a temp file.
+
+    Args:
+        file_format: Export format and file extension ('csv' or 'parquet')
+        writer: Function writing a DataFrame to a path
 
     Returns:
-        File path to the CSV file
+        File path to the exported file, or an error message
     """
     global current_df_storage
     
-    print(f"DEBUG: download_query_results called")
-    print(f"DEBUG: current_df_storage is None: {current_df_storage is None}")
+    if DEBUG:
+        logger.debug("Export requested as %s", file_format)
+        logger.debug("current_df_storage is None: %s", current_df_storage is None)
     
-    if current_df_storage is None or current_df_storage.empty:
+    if current_df_storage is None or current_df_storage.shape[0] == 0:
         error_msg = "No data to download. Please run a query first."
-        print(f"DEBUG: {error_msg}")
+        if DEBUG:
+            logger.debug(error_msg)
         return error_msg
     
+    # Reuse the previous export if the dataframe hasn't changed
+    if id(current_df_storage) != _export_cache['df_id']:
+        _export_cache.update(df_id=id(current_df_storage), csv=None, parquet=None)
+    cached_path = _export_cache[file_format]
+    if cached_path and os.path.exists(cached_path):
+        if DEBUG:
+            logger.debug("Reusing %s file at %s", file_format, cached_path)
+        return cached_path
+
     try:
-        # Create temp CSV file
+        # Create temp file
         temp_dir = tempfile.gettempdir()
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        csv_filename = f"query_results_{timestamp}.csv"
-        csv_path = os.path.join(temp_dir, csv_filename)
+        filename = f"query_results_{timestamp}.{file_format}"
+        file_path = os.path.join(temp_dir, filename)
         
-        # Save dataframe to CSV
-        current_df_storage.to_csv(csv_path, index=False, encoding='utf-8')
+        # Save dataframe
+        writer(current_df_storage, file_path)
+        _export_cache[file_format] = file_path
         
-        print(f"DEBUG: CSV file created at {csv_path}")
-        print(f"DEBUG: File size: {os.path.getsize(csv_path)} bytes")
-        return csv_path
+        if DEBUG:
+            logger.debug("%s file created at %s", file_format, file_path)
+            logger.debug("File size: %d bytes", os.path.getsize(file_path))
+        return file_path
     except Exception as e:
         error_msg = f"Error downloading file: {str(e)}"
-        print(f"DEBUG: {error_msg}")
+        logger.error(error_msg)
         return error_msg
+
+
+def download_query_results() -> str:
+    """
+    Download query results as CSV file.
+
+    Returns:
+        File path to the CSV file
+    """
+    return _export_query_results('csv', _write_csv)
+
+
+def download_query_results_parquet() -> str:
+    """
+    Download query results as Parquet file.
+
+    Returns:
+        File path to the Parquet file
+    """
+    return _export_query_results('parquet', _write_parquet)
     
 
 
@@ -463,6 +692,8 @@ with gr.Blocks(css=css, theme=gr.themes.Monochrome()) as demo:
             # Download button and file output for CSV
             download_btn = gr.Button(" Download as CSV", variant="secondary", size="sm")
             download_file = gr.File(label="Download CSV", interactive=False)
+            download_parquet_btn = gr.Button(" Download as Parquet", variant="secondary", size="sm")
+            download_parquet_file = gr.File(label="Download Parquet", interactive=False)
 
     with gr.Row():
         with gr.Column(elem_classes="result-card"):
@@ -501,7 +732,9 @@ with gr.Blocks(css=css, theme=gr.themes.Monochrome()) as demo:
     submit_btn.click(
         fn=process_request,
         inputs=[user_input],
-        outputs=[sql_output, data_output, chart_output, explanation_output]
+        outputs=[sql_output, data_output, chart_output, explanation_output],
+        concurrency_limit=4,
+        show_progress='minimal'
     )
 
     clear_btn.click(
@@ -522,5 +755,13 @@ with gr.Blocks(css=css, theme=gr.themes.Monochrome()) as demo:
         inputs=None,
         outputs=download_file
     )
+
+    # Download Parquet button action
+    download_parquet_btn.click(
+        fn=download_query_results_parquet,
+        inputs=None,
+        outputs=download_parquet_file
+    )
+    demo.queue(default_concurrency_limit=4, max_size=32)
     if __name__ == "__main__":
         demo.launch(theme=gr.themes.Monochrome())
\ No newline at end of file